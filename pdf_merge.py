@@ -0,0 +1,18 @@
+import io
+import pikepdf
+
+def merge_pdf_pair(first_pdf, second_pdf):
+    """Merge two PDFs given as bytes and return the merged PDF as bytes.
+
+    Kept free of Streamlit calls and in its own module so it can be pickled
+    and run in a worker process.
+    """
+    with pikepdf.open(io.BytesIO(first_pdf)) as merged, pikepdf.open(io.BytesIO(second_pdf)) as second:
+        # Append onto the first document so only the second one's pages are
+        # copied; add_pages_from carries its AcroForm fields over with them
+        merged.add_pages_from(second)
+
+        # Save before the sources close; copied pages still read their streams
+        buf = io.BytesIO()
+        merged.save(buf)
+    return buf.getvalue()
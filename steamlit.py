@@ -1,103 +1,179 @@
+import io
+import itertools
+import multiprocessing
 import os
+import threading
+import time
 import zipfile
-from PyPDF2 import PdfMerger
-import shutil
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 import streamlit as st
+from pdf_merge import merge_pdf_pair
 
-def extract_zip_to_temp_folder(zip_path, temp_folder):
-    """Extract a zip file to a temporary folder."""
-    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        zip_ref.extractall(temp_folder)
+# Seconds between progress redraws while a merge runs in the background
+PROGRESS_INTERVAL = 0.5
 
-def merge_pdfs_by_account(first_zip, second_zip, output_zip):
-    """Merge PDFs by matching account names and create a single zip file with merged PDFs."""
-    first_temp_folder = "first_temp"
-    second_temp_folder = "second_temp"
-    os.makedirs(first_temp_folder, exist_ok=True)
-    os.makedirs(second_temp_folder, exist_ok=True)
+def index_zip(zf):
+    """Map account names to the top-level PDF entries of an open zip file."""
+    # Nested entries (sub folders, macOS __MACOSX/ metadata) are ignored, as when the zip was extracted and listed
+    return {os.path.splitext(info.filename)[0]: info for info in zf.infolist() if info.filename.endswith('.pdf') and '/' not in info.filename}
 
+def summarize_accounts(accounts, limit=20):
+    """Join the first few account names, noting how many more were left out."""
+    shown = ", ".join(accounts[:limit])
+    return f"{shown} …and {len(accounts) - limit} more" if len(accounts) > limit else shown
+
+def make_merge_executor():
+    """Create the executor that runs the merges, falling back to threads where worker processes are unavailable."""
     try:
-        # Extract zip files
-        extract_zip_to_temp_folder(first_zip, first_temp_folder)
-        extract_zip_to_temp_folder(second_zip, second_temp_folder)
-
-        # Get lists of PDFs from both folders
-        first_pdfs = {os.path.splitext(f)[0]: os.path.join(first_temp_folder, f) for f in os.listdir(first_temp_folder) if f.endswith('.pdf')}
-        second_pdfs = {os.path.splitext(f)[0]: os.path.join(second_temp_folder, f) for f in os.listdir(second_temp_folder) if f.endswith('.pdf')}
-
-        # Create the output zip file
-        with zipfile.ZipFile(output_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for account, first_pdf_path in first_pdfs.items():
-                if account in second_pdfs:
-                    second_pdf_path = second_pdfs[account]
-
-                    # Validate PDFs
-                    if os.path.getsize(first_pdf_path) == 0 or os.path.getsize(second_pdf_path) == 0:
-                        st.warning(f"Skipping empty file for account: {account}")
-                        continue
-                    
+        # Never fork the multi-threaded Streamlit server; forkserver/spawn
+        # workers import merge_pdf_pair from pdf_merge instead
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        return ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context(start_method))
+    except (OSError, NotImplementedError):
+        # e.g. sandboxed hosts without POSIX semaphores
+        return ThreadPoolExecutor(max_workers=4)
+
+def merge_pdfs_by_account(first_zip, second_zip, output_zip, progress_callback=None, cancel_event=None):
+    """Merge PDFs by matching account names and create a single zip file with merged PDFs.
+
+    Makes no Streamlit calls so it can run off the script thread; progress is
+    reported through progress_callback(done, total) and setting cancel_event
+    stops submitting new merges. Returns the unmatched, skipped and failed accounts
+    and whether the batch was cut short by a cancel.
+    """
+    with zipfile.ZipFile(first_zip, 'r') as first_zf, zipfile.ZipFile(second_zip, 'r') as second_zf:
+        # Index the PDFs in both zip files without extracting them
+        first_pdfs = index_zip(first_zf)
+        second_pdfs = index_zip(second_zf)
+
+        # Collect the accounts to merge, in a stable order, and those with no match
+        matched = first_pdfs.keys() & second_pdfs.keys()
+        only_in_first = sorted(first_pdfs.keys() - second_pdfs.keys())
+        only_in_second = sorted(second_pdfs.keys() - first_pdfs.keys())
+        accounts = []
+        empty_accounts = []
+        for account in sorted(matched):
+            # Validate PDFs from the central directory before reading them
+            if first_pdfs[account].file_size == 0 or second_pdfs[account].file_size == 0:
+                empty_accounts.append(account)
+                continue
+
+            accounts.append(account)
+
+        if progress_callback is not None:
+            progress_callback(0, len(accounts))
+
+        # Merge in the executor and write the results from this thread only.
+        # Inputs are read just ahead of the workers, so only a bounded number of
+        # PDFs is held in memory and reading overlaps with merging.
+        # The merged PDFs are already Flate-compressed, so store them as-is.
+        max_pending = 2 * (os.cpu_count() or 1)
+        with zipfile.ZipFile(output_zip, 'w', zipfile.ZIP_STORED) as zipf, make_merge_executor() as executor:
+            remaining = iter(accounts)
+            pending = {}
+            failed = []
+            done = 0
+            cancelled = False
+            while True:
+                # Only an unfinished batch counts as cancelled
+                if cancel_event is not None and cancel_event.is_set() and done < len(accounts):
+                    for future in pending:
+                        future.cancel()
+                    cancelled = True
+                    break
+
+                # Top up the executor before waiting on it
+                for account in itertools.islice(remaining, max_pending - len(pending)):
+                    first_pdf = first_zf.read(first_pdfs[account])
+                    second_pdf = second_zf.read(second_pdfs[account])
+                    pending[executor.submit(merge_pdf_pair, first_pdf, second_pdf)] = account
+                if not pending:
+                    break
+
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    account = pending.pop(future)
                     try:
-                        merger = PdfMerger()
-                        merger.append(first_pdf_path)
-                        merger.append(second_pdf_path)
-
-                        # Save the merged PDF
-                        merged_pdf_path = f"{account}.pdf"
-                        merger.write(merged_pdf_path)
-                        merger.close()
-
-                        # Add to the zip file
-                        zipf.write(merged_pdf_path, arcname=os.path.basename(merged_pdf_path))
-
-                        # Remove the temporary merged file
-                        os.remove(merged_pdf_path)
+                        zipf.writestr(f"{account}.pdf", future.result())
                     except Exception as e:
-                        st.error(f"Error merging files for account {account}: {e}")
-
-        return output_zip
-
-    finally:
-        # Clean up temporary folders
-        shutil.rmtree(first_temp_folder, ignore_errors=True)
-        shutil.rmtree(second_temp_folder, ignore_errors=True)
-
-# Streamlit App
-st.title("PDF Merger App")
-st.write("Upload two zip files containing PDFs with matching account numbers. The app will merge the PDFs and return a zip file containing the results.")
-
-# File upload
-first_zip_file = st.file_uploader("Upload the first zip file containing PDFs", type=["zip"])
-second_zip_file = st.file_uploader("Upload the second zip file containing PDFs", type=["zip"])
-
-if first_zip_file and second_zip_file:
-    if st.button("Merge PDFs"):
-        # Save the uploaded files temporarily
-        first_zip_path = "first_uploaded.zip"
-        second_zip_path = "second_uploaded.zip"
-        
-        with open(first_zip_path, "wb") as f:
-            f.write(first_zip_file.read())
-        with open(second_zip_path, "wb") as f:
-            f.write(second_zip_file.read())
-
-        # Output zip file name
-        output_zip_path = "merged_pdfs.zip"
-
-        # Merge PDFs
-        try:
-            merge_pdfs_by_account(first_zip_path, second_zip_path, output_zip_path)
-            st.success("PDFs have been merged successfully!")
-
-            # Provide download link
-            with open(output_zip_path, "rb") as f:
-                st.download_button(label="Download Merged Zip File", data=f, file_name="merged_pdfs.zip", mime="application/zip")
-        except Exception as e:
-            st.error(f"An error occurred: {e}")
-        finally:
-            # Cleanup temporary files
-            if os.path.exists(first_zip_path):
-                os.remove(first_zip_path)
-            if os.path.exists(second_zip_path):
-                os.remove(second_zip_path)
-            if os.path.exists(output_zip_path):
-                os.remove(output_zip_path)
+                        failed.append(f"{account}: {e}")
+                    done += 1
+                    if progress_callback is not None:
+                        progress_callback(done, len(accounts))
+
+    return {"only_in_first": only_in_first, "only_in_second": only_in_second, "empty_accounts": empty_accounts, "failed": failed, "cancelled": cancelled}
+
+def get_merge_runner():
+    """Background thread, one per browser session, that runs merge_pdfs_by_account off the script thread."""
+    if "merge_runner" not in st.session_state:
+        st.session_state["merge_runner"] = ThreadPoolExecutor(max_workers=1)
+    return st.session_state["merge_runner"]
+
+def main():
+    """Render the Streamlit app."""
+    st.title("PDF Merger App")
+    st.write("Upload two zip files containing PDFs with matching account numbers. The app will merge the PDFs and return a zip file containing the results.")
+
+    # File upload
+    first_zip_file = st.file_uploader("Upload the first zip file containing PDFs", type=["zip"])
+    second_zip_file = st.file_uploader("Upload the second zip file containing PDFs", type=["zip"])
+
+    uploads = (first_zip_file.file_id, second_zip_file.file_id) if first_zip_file and second_zip_file else None
+    job = st.session_state.get("merge_job")
+    merge_running = job is not None and not job["future"].done()
+
+    # A finished result only belongs to the uploads it was merged from
+    if job is not None and not merge_running and job["uploads"] != uploads:
+        del st.session_state["merge_job"]
+        job = None
+
+    if first_zip_file and second_zip_file:
+        if st.button("Merge PDFs", disabled=merge_running):
+            # Run the merge in the background so the script can keep redrawing;
+            # the uploads are read in place (UploadedFile is a seekable BytesIO)
+            job = {"uploads": uploads, "output": io.BytesIO(), "progress": {"done": 0, "total": 0}, "cancel": threading.Event()}
+            job["future"] = get_merge_runner().submit(
+                merge_pdfs_by_account, first_zip_file, second_zip_file, job["output"],
+                lambda done, total: job["progress"].update(done=done, total=total), job["cancel"],
+            )
+            st.session_state["merge_job"] = job
+            merge_running = True
+
+    if job is not None:
+        future = job["future"]
+        if merge_running:
+            # Redraw progress from the counters the worker updates, then poll again
+            done, total = job["progress"]["done"], job["progress"]["total"]
+            st.progress(done / total if total else 0.0, text=f"Merged {done} of {total} accounts")
+            if st.button("Cancel"):
+                job["cancel"].set()
+                future.cancel()
+            time.sleep(PROGRESS_INTERVAL)
+            st.rerun()
+        elif future.cancelled():
+            st.warning("The merge was cancelled.")
+        else:
+            try:
+                result = future.result()
+            except Exception as e:
+                st.error(f"An error occurred: {e}")
+            else:
+                if result["cancelled"]:
+                    st.warning("The merge was cancelled.")
+                else:
+                    # Report all unmatched, skipped and failed accounts in a single message each
+                    for key, source in (("only_in_first", "first"), ("only_in_second", "second")):
+                        if result[key]:
+                            st.warning(f"Skipped {len(result[key])} account(s) found only in the {source} zip file: {summarize_accounts(result[key])}")
+                    if result["empty_accounts"]:
+                        st.warning(f"Skipping empty files for accounts: {summarize_accounts(result['empty_accounts'])}")
+                    if result["failed"]:
+                        st.error("Error merging files for accounts:\n\n" + "\n".join(f"- {failure}" for failure in result["failed"]))
+                    st.success("PDFs have been merged successfully!")
+
+                    # Provide download link
+                    st.download_button(label="Download Merged Zip File", data=job["output"].getvalue(), file_name="merged_pdfs.zip", mime="application/zip")
+
+# Streamlit runs the script as __main__; spawn/forkserver workers import it as __mp_main__
+if __name__ == "__main__":
+    main()